@@ -4,6 +4,7 @@
 from copy import deepcopy
 from pdb import set_trace
 import json
+import os
 
 import numpy as np
 import torch
@@ -263,9 +264,12 @@ class BaseSGGenerator(nn.Module):
 
     def _set_probabilities(self):
         """Set predicate probability matrix for given dataset."""
-        json_name = self.json_path + self.dataset + '_probabilities.json'
-        with open(json_name) as fid:
-            probs = torch.from_numpy(np.array(json.load(fid))).float()
+        name = self.json_path + self.dataset + '_probabilities'
+        if os.path.exists(name + '.npy'):
+            probs = torch.from_numpy(np.load(name + '.npy')).float()
+        else:  # annotations transformed by older versions
+            with open(name + '.json') as fid:
+                probs = torch.from_numpy(np.array(json.load(fid))).float()
         self.probabilities = probs.to(self._device)
 
     def _set_word2vec(self):
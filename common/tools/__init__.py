@@ -2,4 +2,5 @@
 
 from .annotation_loader import AnnotationLoader
 from .early_stopping_scheduler import EarlyStopping
+from .merged_connections import load_merged_connections
 from .spatial_feature_extractor import SpatialFeatureExtractor
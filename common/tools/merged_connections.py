@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""Load the merged predicate classes of a dataset."""
+
+import gzip
+import os
+import pickle
+
+
+def load_merged_connections(json_path, dataset):
+    """
+    Load the {(subj_class, obj_class): merged predicate ids} dict.
+
+    Reads <dataset>_merged.pkl.gz, or the uncompressed
+    <dataset>_merged.pkl written by older dataset transformations.
+    """
+    merged_pkl = json_path + dataset + '_merged.pkl'
+    if os.path.exists(merged_pkl + '.gz'):
+        with gzip.open(merged_pkl + '.gz', 'rb') as fid:
+            return pickle.load(fid)
+    with open(merged_pkl, 'rb') as fid:
+        return pickle.load(fid)
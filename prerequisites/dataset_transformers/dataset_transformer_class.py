@@ -1,14 +1,42 @@
 # -*- coding: utf-8 -*-
 """Transform datasets annotations into a standard desired format."""
 
+from collections import defaultdict
+import gzip
+from inspect import signature
+from itertools import chain, combinations
 import json
 import os
 import pickle
 import shutil
 from zipfile import ZipFile
 
+try:
+    import imagesize
+except ImportError:  # fall back to PIL
+    imagesize = None
+from joblib import Parallel, cpu_count, delayed
+try:
+    from numba import njit
+except ImportError:  # fall back to NumPy broadcasting
+    njit = None
 import numpy as np
+try:
+    import orjson
+except ImportError:  # fall back to the standard json module
+    orjson = None
 from PIL import Image
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# imagesize>=2 applies EXIF rotation by default, PIL's size never does
+_IMAGESIZE_KWARGS = (
+    {'exif_rotation': False}
+    if imagesize is not None
+    and 'exif_rotation' in signature(imagesize.get).parameters
+    else {}
+)
+_MAX_CHUNKS = 8  # one chunk per worker, each chunk pickles its arguments
 
 
 class DatasetTransformer:
@@ -30,18 +58,20 @@ class DatasetTransformer:
         """Initialize transformer providing the dataset name."""
         self._dataset = config.dataset
         self._glove_txt = config.glove_txt
+        self._im_sizes = None  # cache of (height, width) per image name
         self._orig_annos_path = config.orig_annos_path
         self._orig_images_path = config.orig_img_path
         assert os.path.exists(self._orig_images_path)
         base = config.paths['json_path'] + self._dataset
         # When training the baseline model, please comment out the line below; otherwise, keep it uncommented.
         self._conceptnet_json = base + '_conceptnet.json' 
-        self._merged_json = base + '_merged.pkl'
+        self._im_size_json = base + '_im_sizes.json'
+        self._merged_json = base + '_merged.pkl.gz'
         self._negative_json = base + '_negatives.json'
         self._preddet_json = base + '_preddet.json'
         self._predcls_json = base + '_predcls.json'
         self._predicate_json = base + '_predicates.json'
-        self._probability_json = base + '_probabilities.json'
+        self._probability_json = base + '_probabilities.npy'
         self._object_json = base + '_objects.json'
         self._word2vec_json = base + '_word2vec.json'
         self.r1_preds = []  # rule 1 predicates
@@ -57,9 +87,12 @@ class DatasetTransformer:
             self._object_json,
             self._word2vec_json
         ]
+        preddet_annos = None
         if not all(os.path.exists(anno) for anno in jsons):
             self.download_annotations()
             annos = self.create_relationship_json()
+            if self._im_sizes is not None:
+                _dump_json(self._im_sizes, self._im_size_json)
             annos = self._transform_annotations(annos)
             predicates, objects = self.save_predicates_objects(annos)
             if not os.path.exists(self._word2vec_json):
@@ -68,43 +101,53 @@ class DatasetTransformer:
             if not os.path.exists(self._conceptnet_json):
                # When training the baseline model, please comment out the line below; otherwise, keep it uncommented.
                self.save_conceptnet_vectors(predicates, objects)
-            annos = self.update_labels(annos, predicates, objects)
-            with open(self._preddet_json, 'w') as fid:
-                json.dump(annos, fid)
-        if self._dataset not in {'VG80K', 'VrR-VG'}:
-            with open(self._preddet_json) as fid:
-                annos = json.load(fid)
-            if not os.path.exists(self._predcls_json):
-                self.create_pred_cls_json(annos, predicates)
-            with open(self._predicate_json) as fid:
-                predicates = json.load(fid)
-            with open(self._object_json) as fid:
-                objects = json.load(fid)
-            if not os.path.exists(self._probability_json):
-                with open(self._predcls_json) as fid:
-                    annos = json.load(fid)
-                prob_matrix = self.compute_relationship_probabilities(
-                    annos, predicates, objects)
-                with open(self._probability_json, 'w') as fid:
-                    json.dump(prob_matrix, fid)
-            # Merged classes
-            if not os.path.exists(self._merged_json):
-                with open(self._predcls_json) as fid:
-                    annos = json.load(fid)
-                connections = self.compute_class_merging(annos, predicates)
-                annos = self.update_annos_with_syns(annos, connections)
-                with open(self._predcls_json, 'w') as fid:
-                    json.dump(annos, fid)
-                with open(self._preddet_json) as fid:
-                    annos = json.load(fid)
-                annos = self.update_annos_with_syns(annos, connections)
-                with open(self._preddet_json, 'w') as fid:
-                    json.dump(annos, fid)
-                with open(self._merged_json, 'wb') as fid:
-                    pickle.dump(connections, fid)
-            # Negatives
-            if not os.path.exists(self._negative_json):
-                self.save_negative_json()
+            preddet_annos = self.update_labels(annos, predicates, objects)
+            _dump_json_list(preddet_annos, self._preddet_json)
+        outputs = [
+            self._predcls_json,
+            self._probability_json,
+            self._merged_json,
+            self._negative_json
+        ]
+        if (self._dataset not in {'VG80K', 'VrR-VG'}
+                and not all(os.path.exists(name) for name in outputs)):
+            self._transform_predcls(preddet_annos)
+
+    def _transform_predcls(self, preddet_annos=None):
+        """Run the PredCls stages, keeping annotations in memory."""
+        if preddet_annos is None:
+            preddet_annos = _load_json(self._preddet_json)
+        predicates = _load_json(self._predicate_json)
+        objects = _load_json(self._object_json)
+        save_predcls = not os.path.exists(self._predcls_json)
+        if save_predcls:
+            predcls_annos = self.create_pred_cls_json(
+                preddet_annos, predicates)
+        else:
+            predcls_annos = _load_json(self._predcls_json)
+        if not os.path.exists(self._probability_json):
+            prob_matrix = self.compute_relationship_probabilities(
+                predcls_annos, predicates, objects)
+            np.save(self._probability_json, prob_matrix)
+        # Merged classes
+        if not os.path.exists(self._merged_json):
+            connections = self.compute_class_merging(
+                predcls_annos, predicates)
+            predcls_annos = self.update_annos_with_syns(
+                predcls_annos, connections)
+            preddet_annos = self.update_annos_with_syns(
+                preddet_annos, connections)
+            # Save annotations before the merged file marks the stage done
+            _dump_json_list(predcls_annos, self._predcls_json)
+            _dump_json_list(preddet_annos, self._preddet_json)
+            save_predcls = False
+            with gzip.open(self._merged_json, 'wb', compresslevel=1) as fid:
+                pickle.dump(connections, fid, protocol=5)
+        # Negatives
+        if not os.path.exists(self._negative_json):
+            self.save_negative_json(predcls_annos)
+        if save_predcls:
+            _dump_json_list(predcls_annos, self._predcls_json)
 
     @staticmethod
     def create_relationship_json():
@@ -130,11 +173,12 @@ class DatasetTransformer:
         """
         return []
 
-    def create_pred_cls_json(self, annos, predicates):
+    @staticmethod
+    def create_pred_cls_json(annos, predicates):
         """
         Annotate all possible pairs, adding background classes.
 
-        Saves a list of dicts:
+        Returns a new list of dicts:
         {
             'filename': filename (no path),
             'split_id': int, 0/1/2 for train/val/test,
@@ -153,41 +197,8 @@ class DatasetTransformer:
             }
         }
         """
-        for anno in annos:
-            pairs = {
-                (s, o): []
-                for s in range(len(anno['objects']['ids']))
-                for o in range(len(anno['objects']['ids']))
-                if s != o
-            }
-            for rel in range(len(anno['relations']['subj_ids'])):
-                subj_id = anno['relations']['subj_ids'][rel]
-                obj_id = anno['relations']['obj_ids'][rel]
-                if (subj_id, obj_id) not in pairs:
-                    pairs[(subj_id, obj_id)] = []
-                pairs[(subj_id, obj_id)].append((
-                    anno['relations']['names'][rel],
-                    anno['relations']['ids'][rel]
-                ))
-            pairs = {
-                rel_tuple:
-                    rels if any(rels)
-                    else [('__background__', len(predicates) - 1)]
-                for rel_tuple, rels in pairs.items()}
-            pairs = np.array([
-                (subj_id, obj_id, name, pred_id)
-                for (subj_id, obj_id), preds in pairs.items()
-                for (name, pred_id) in preds
-            ])
-            if pairs.size:
-                anno['relations'] = {
-                    'subj_ids': pairs[:, 0].astype(int).tolist(),
-                    'obj_ids': pairs[:, 1].astype(int).tolist(),
-                    'names': pairs[:, 2].astype(str).tolist(),
-                    'ids': pairs[:, 3].astype(int).tolist()
-                }
-        with open(self._predcls_json, 'w') as fid:
-            json.dump(annos, fid)
+        return _flatten(_map_chunks(
+            _create_pred_cls_chunk, annos, len(predicates)))
 
     @staticmethod
     def download_annotations():
@@ -201,13 +212,11 @@ class DatasetTransformer:
             if name != '__background__'
         )))
         predicates.append('__background__')
-        with open(self._predicate_json, 'w') as fid:
-            json.dump(predicates, fid)
+        _dump_json(predicates, self._predicate_json)
         objects = sorted(list(set(
             name for anno in annos for name in anno['objects']['names']
         )))
-        with open(self._object_json, 'w') as fid:
-            json.dump(objects, fid)
+        _dump_json(objects, self._object_json)
         return predicates, objects
 
     def save_word2vec_vectors(self, predicates, objects):
@@ -215,30 +224,30 @@ class DatasetTransformer:
         if not os.path.exists(self._glove_txt):
             self._download_glove()
         voc = {word for name in predicates + objects for word in name.split()}
+        glove_w2v = {}
         with open(self._glove_txt, encoding="utf-8") as fid:
-            glove_w2v = {
-                line.split()[0]: np.array(line.split()[1:]).astype(float)
-                for line in fid.readlines() if line.split()[0] in voc
-            }
+            for line in fid:  # stream, GloVe does not fit in memory
+                word, _, vec = line.partition(' ')
+                if word not in voc:
+                    continue
+                glove_w2v[word] = np.fromstring(vec, sep=' ', dtype=np.float32)
         print(list(voc - glove_w2v.keys()))
         assert list(voc - glove_w2v.keys()) == ['__background__']
-        pred_w2v = np.array([
-            np.mean([glove_w2v[word] for word in name.split()], axis=0)
-            if any(word in glove_w2v for word in name.split())
-            else np.zeros(300)
-            for name in predicates
-        ])
+        pred_w2v = mean_pool_vectors(
+            [
+                name.split() if name != '__background__' else []
+                for name in predicates
+            ],
+            glove_w2v
+        )
         # Set background as the mean of other classes
         pred_w2v[-1] = np.mean(pred_w2v[:-1, :], axis=0)
-        obj_w2v = np.array([
-            np.mean([glove_w2v[word] for word in name.split()], axis=0)
-            for name in objects
-        ])
-        with open(self._word2vec_json, 'w') as fid:
-            json.dump({
-                'predicates': pred_w2v.tolist(),
-                'objects': obj_w2v.tolist()
-            }, fid)
+        obj_w2v = mean_pool_vectors(
+            [name.split() for name in objects], glove_w2v)
+        _dump_json({
+            'predicates': pred_w2v.tolist(),
+            'objects': obj_w2v.tolist()
+        }, self._word2vec_json)
 
     def save_conceptnet_vectors(self, predicates, objects):
         """Build conceptnet dictionary of dataset vocabulary."""
@@ -246,11 +255,6 @@ class DatasetTransformer:
             self._download_glove()
         # Please replace the following line with your path.
         conceptNet_numberbatch_file_path = 'C:\\Users\\user\\Desktop\\final_project_external_knowledge\\prerequisites\\numberbatch-en-19.08.txt' 
-        with open(conceptNet_numberbatch_file_path, encoding='utf-8') as fid:
-            en_w2v = {
-                line.split()[0]: np.array(line.split()[1:]).astype(float)
-                for line in fid.readlines()
-            }
         interpretations = {name: [name] for name in predicates + objects}
         interpretations.update({
             'in the front of': ['in front of'],
@@ -271,32 +275,42 @@ class DatasetTransformer:
             'walk next to': ['walk', 'next to'],
             'walk past': ['walk', 'past']
         })
-        pred_w2v = np.array([
-            np.mean([
-                en_w2v['_'.join(word.split())]
-                for word in interpretations[name]
-            ], axis=0)
-            if name != '__background__'
-            else np.zeros(300)
-            for name in predicates
-        ])
+        voc = {
+            '_'.join(word.split())
+            for words in interpretations.values() for word in words
+        }
+        en_w2v = {}
+        with open(conceptNet_numberbatch_file_path, encoding='utf-8') as fid:
+            for line in fid:  # stream, keep only the vocabulary needed
+                word, _, vec = line.partition(' ')
+                if word not in voc:
+                    continue
+                en_w2v[word] = np.fromstring(vec, sep=' ', dtype=np.float32)
+        pred_w2v = mean_pool_vectors(
+            [
+                ['_'.join(word.split()) for word in interpretations[name]]
+                if name != '__background__' else []
+                for name in predicates
+            ],
+            en_w2v
+        )
         # Set background as the mean of other classes
         pred_w2v[-1] = np.mean(pred_w2v[:-1, :], axis=0)
-        obj_w2v = np.array([
-            np.mean([
-                en_w2v['_'.join(word.split())]
-                for word in interpretations[name]
-            ], axis=0)
-            for name in objects
-        ])
+        obj_w2v = mean_pool_vectors(
+            [
+                ['_'.join(word.split()) for word in interpretations[name]]
+                for name in objects
+            ],
+            en_w2v
+        )
         # Normalize embeddings
-        pred_w2v = pred_w2v / np.sqrt(np.sum(pred_w2v ** 2, axis=1))[:, None]
-        obj_w2v = obj_w2v / np.sqrt(np.sum(obj_w2v ** 2, axis=1))[:, None]
-        with open(self._conceptnet_json, 'w') as fid:
-            json.dump({
-                'predicates': pred_w2v.tolist(),
-                'objects': obj_w2v.tolist()
-            }, fid)
+        for w2v in (pred_w2v, obj_w2v):
+            norms = np.linalg.norm(w2v, axis=1, keepdims=True)
+            np.divide(w2v, np.where(norms == 0, 1, norms), out=w2v)
+        _dump_json({
+            'predicates': pred_w2v.tolist(),
+            'objects': obj_w2v.tolist()
+        }, self._conceptnet_json)
 
     @staticmethod
     def update_labels(annos, predicates, objects):
@@ -311,10 +325,24 @@ class DatasetTransformer:
         return annos
 
     def _compute_im_size(self, im_name):
-        """Compute image size."""
+        """Compute image size, reading only the image header if possible."""
+        if self._im_sizes is None:
+            self._im_sizes = (
+                _load_json(self._im_size_json)
+                if os.path.exists(self._im_size_json) else {}
+            )
+        if im_name in self._im_sizes:
+            return tuple(self._im_sizes[im_name])
         if not os.path.exists(self._orig_images_path + im_name):
             return None, None
-        im_width, im_height = Image.open(self._orig_images_path + im_name).size
+        im_width, im_height = -1, -1
+        if imagesize is not None:
+            im_width, im_height = imagesize.get(
+                self._orig_images_path + im_name, **_IMAGESIZE_KWARGS)
+        if im_width < 0:  # format not handled by imagesize
+            im_width, im_height = Image.open(
+                self._orig_images_path + im_name).size
+        self._im_sizes[im_name] = (im_height, im_width)
         return im_height, im_width
 
     @staticmethod
@@ -328,70 +356,75 @@ class DatasetTransformer:
             N(X) is the number of occurences of X and
             V_A is the number of different values that A can have
 
-        Returns a (n_obj, n_obj, n_rel) array where P[i,j,k] = P(k|i,j)
+        Returns a (n_obj, n_obj, n_rel) float16 array where
+        P[i,j,k] = P(k|i,j)
         """
-        prob_matrix = np.ones((len(objects), len(objects), len(predicates)))
-        for anno in annos:
-            if anno['split_id'] == 0 and any(anno['relations']['names']):
-                ids = np.array(anno['objects']['ids'])
-                unique_triplets = np.unique(np.stack((
-                    anno['relations']['subj_ids'],
-                    anno['relations']['obj_ids'],
-                    anno['relations']['ids']
-                ), axis=1), axis=0)
-                prob_matrix[
-                    ids[unique_triplets[:, 0]],
-                    ids[unique_triplets[:, 1]],
-                    unique_triplets[:, 2]] += 1
-        prob_matrix /= prob_matrix.sum(2)[:, :, None]
-        return prob_matrix.tolist()
+        shape = (len(objects), len(objects), len(predicates))
+        triplets = _map_chunks(_unique_triplets_chunk, annos, shape)
+        counts = np.zeros(shape, dtype=np.int32)
+        np.add.at(  # in place through a flat view, no int64 temporary
+            counts.reshape(-1),
+            np.concatenate([np.zeros(0, int)] + triplets),
+            1
+        )
+        prob_matrix = counts.astype(np.float32)
+        prob_matrix += 1
+        prob_matrix /= prob_matrix.sum(2, keepdims=True)
+        return prob_matrix.astype(np.float16)
 
     def compute_class_merging(self, annos, predicates):
         """Estimate synonyms to merge during evaluation."""
-        # Adjacency matrices only for existing pairs to reduce memory
-        pairs = set(
-            (subj, obj)
-            for anno in annos
-            if anno['relations']['ids']
-            for subj, obj in zip(
-                np.array(anno['objects']['ids'])[
-                    np.array(anno['relations']['subj_ids'])
-                ],
-                np.array(anno['objects']['ids'])[
-                    np.array(anno['relations']['obj_ids'])
-                ]
-            )
-        )
-        connections = {pair: np.eye(len(predicates)) for pair in pairs}
-        # Fill adjacency matrices
+        # Predicate edges only for existing pairs to reduce memory
+        connections = {}
         for anno in annos:
             relations = anno['relations']
             objects = anno['objects']['ids']
-            pairs = np.stack(
-                (relations['subj_ids'], relations['obj_ids']),
-                axis=1
-            )
-            # Find pairs with same (subj_id, obj_id)
-            common_pairs = (pairs[..., None] == pairs.T[None, ...]).all(1) * 1
-            nz_i, nz_j = common_pairs.nonzero()
-            for ind_i, ind_j in zip(nz_i, nz_j):
-                connections[
-                    objects[relations['subj_ids'][ind_i]],
-                    objects[relations['obj_ids'][ind_j]]
-                ][relations['ids'][ind_i], relations['ids'][ind_j]] = 1
+            # Group relations with same (subj_id, obj_id)
+            common_pairs = defaultdict(list)
+            for rel, (subj_id, obj_id) in enumerate(zip(
+                    relations['subj_ids'], relations['obj_ids'])):
+                common_pairs[(subj_id, obj_id)].append(relations['ids'][rel])
+            for (subj_id, obj_id), rel_ids in common_pairs.items():
+                edges = connections.setdefault(
+                    (objects[subj_id], objects[obj_id]), [])
+                edges.extend(combinations(rel_ids, 2))
         # Densify connections (a synomym of my synonym is also mine)
-        for key, mat in connections.items():
-            connections[key] = self._densify_mat(mat).argmax(1).tolist()
-        return connections
+        return self._merge_synonyms(connections, len(predicates))
 
     @staticmethod
-    def _densify_mat(mat):
-        """Densify matrices per pair."""
-        old_mat = np.zeros_like(mat)
-        while (mat != old_mat).any():
-            old_mat = np.copy(mat)
-            mat = np.minimum(mat + np.matmul(mat.T, mat), 1)
-        return mat
+    def _merge_synonyms(connections, n_predicates):
+        """
+        Map each predicate to the lowest id of its synonyms' component.
+
+        All pairs are stacked into one block-diagonal graph, pair k owning
+        nodes [k * n_predicates, (k + 1) * n_predicates), so that
+        connected components are computed in a single call.
+        """
+        if not connections:
+            return {}
+        pairs = list(connections)
+        edges = np.array(
+            [edge for pair in pairs for edge in connections[pair]],
+            dtype=np.int64
+        ).reshape(-1, 2)
+        offsets = np.repeat(
+            np.arange(len(pairs)) * n_predicates,
+            [len(connections[pair]) for pair in pairs]
+        )
+        n_nodes = len(pairs) * n_predicates
+        graph = coo_matrix(
+            (
+                np.ones(len(edges), dtype=bool),
+                (edges[:, 0] + offsets, edges[:, 1] + offsets)
+            ),
+            shape=(n_nodes, n_nodes)
+        )
+        _, labels = connected_components(graph, directed=False)
+        merged_ids = np.full(labels.max() + 1, n_predicates)
+        np.minimum.at(
+            merged_ids, labels, np.tile(np.arange(n_predicates), len(pairs)))
+        merged_ids = merged_ids[labels].reshape(len(pairs), n_predicates)
+        return dict(zip(pairs, merged_ids.tolist()))
 
     @staticmethod
     def update_annos_with_syns(annos, connections):
@@ -408,51 +441,18 @@ class DatasetTransformer:
             ])
         return annos
 
-    def save_negative_json(self):
+    def save_negative_json(self, annos):
         """
         Mine negative examples for certain predicates using rules.
 
         (r1) Do not share: if (S1, P, O) then !(S2, P, O)
         (r2) Don't be shared: if (S, P, O1) then !(S, P, O2)
         """
-        with open(self._predcls_json) as fid:
-            annos = json.load(fid)
         negatives = {}
-        for anno in annos:
-            relations = anno['relations']
-            neg_ids = [[] for _ in range(len(relations['ids']))]
-            for n_cnt, name in enumerate(relations['names']):
-                obj_id = relations['obj_ids'][n_cnt]
-                subj_id = relations['subj_ids'][n_cnt]
-                obj_box = anno['objects']['boxes'][obj_id]
-                subj_box = anno['objects']['boxes'][subj_id]
-                if name in self.r1_preds:
-                    for r_cnt, rel in enumerate(relations['names']):
-                        this_subj_id = relations['subj_ids'][r_cnt]
-                        this_subj_box = anno['objects']['boxes'][this_subj_id]
-                        rule_applies = (
-                            this_subj_id != subj_id  # not S1
-                            and compute_overlap(this_subj_box, subj_box) < 0.9
-                            and rel != name  # not annotated with P
-                            and relations['obj_ids'][r_cnt] == obj_id  # same O
-                        )
-                        if rule_applies:
-                            neg_ids[r_cnt].append(relations['ids'][n_cnt])
-                elif name in self.r2_preds:
-                    for r_cnt, rel in enumerate(relations['names']):
-                        this_obj_id = relations['obj_ids'][r_cnt]
-                        this_obj_box = anno['objects']['boxes'][this_obj_id]
-                        rule_applies = (
-                            relations['subj_ids'][r_cnt] == subj_id  # same S
-                            and rel != name  # not annotated with P
-                            and this_obj_id != obj_id  # not O1
-                            and compute_overlap(this_obj_box, obj_box) < 0.9
-                        )
-                        if rule_applies:
-                            neg_ids[r_cnt].append(relations['ids'][n_cnt])
-            negatives[anno['filename']] = neg_ids
-        with open(self._negative_json, 'w') as fid:
-            json.dump(negatives, fid)
+        for chunk_negatives in _map_chunks(
+                _mine_negatives_chunk, annos, self.r1_preds, self.r2_preds):
+            negatives.update(chunk_negatives)
+        _dump_json(negatives, self._negative_json)
 
     def _download_glove(self):
         """Download GloVe embeddings."""
@@ -489,49 +489,7 @@ class DatasetTransformer:
                 }
             }
         """
-        objects = [
-            {
-                obj_tuple: o
-                for o, obj_tuple in enumerate(sorted(list(
-                    set(
-                        (tuple(rel['subject_box']), rel['subject'])
-                        for rel in anno['relationships']
-                    ).union(set(
-                        (tuple(rel['object_box']), rel['object'])
-                        for rel in anno['relationships']
-                    ))
-                ), key=lambda t: (t[0][2] + t[0][3])))
-            }
-            for anno in annos
-        ]
-        inv_objects = [
-            {v: k for k, v in obj_dict.items()} for obj_dict in objects]
-        relationships = [
-            {
-                'names': [rel['predicate'] for rel in anno['relationships']],
-                'subj_ids': [
-                    obj_dict[(tuple(rel['subject_box']), rel['subject'])]
-                    for rel in anno['relationships']],
-                'obj_ids': [
-                    obj_dict[(tuple(rel['object_box']), rel['object'])]
-                    for rel in anno['relationships']]
-            }
-            for anno, obj_dict in zip(annos, objects)
-        ]
-        return [
-            {
-                'filename': anno['filename'],
-                'split_id': anno['split_id'],
-                'height': anno['height'],
-                'width': anno['width'],
-                'objects': {
-                    'names': [objs[o][1] for o in sorted(objs.keys())],
-                    'boxes': [objs[o][0] for o in sorted(objs.keys())]
-                },
-                'relations': relations
-            }
-            for anno, relations, objs in zip(annos, relationships, inv_objects)
-        ]
+        return _flatten(_map_chunks(_transform_annotations_chunk, annos))
 
 
 def compute_area(bbox):
@@ -552,3 +510,261 @@ def compute_overlap(bbox0, bbox1):
                   + compute_area(bbox1)
                   - intersection_area)
     return intersection_area / union_area
+
+
+def compute_pairwise_overlaps(bboxes0, bboxes1):
+    """Compute (N, M) overlaps between (N, 4) and (M, 4) arrays of boxes."""
+    if njit is not None:
+        return _pairwise_overlaps_kernel(
+            np.asarray(bboxes0, dtype=float).reshape(-1, 4),
+            np.asarray(bboxes1, dtype=float).reshape(-1, 4))
+    bboxes0 = np.asarray(bboxes0, dtype=float)[:, None, :]
+    bboxes1 = np.asarray(bboxes1, dtype=float)[None, :, :]
+    intersection_area = (
+        np.maximum(0, np.minimum(bboxes0[..., 3], bboxes1[..., 3])
+                   - np.maximum(bboxes0[..., 2], bboxes1[..., 2]) + 1)
+        * np.maximum(0, np.minimum(bboxes0[..., 1], bboxes1[..., 1])
+                     - np.maximum(bboxes0[..., 0], bboxes1[..., 0]) + 1)
+    )
+    union_area = (
+        np.maximum(0, bboxes0[..., 3] - bboxes0[..., 2] + 1)
+        * np.maximum(0, bboxes0[..., 1] - bboxes0[..., 0] + 1)
+        + np.maximum(0, bboxes1[..., 3] - bboxes1[..., 2] + 1)
+        * np.maximum(0, bboxes1[..., 1] - bboxes1[..., 0] + 1)
+        - intersection_area
+    )
+    return intersection_area / union_area
+
+
+def _pairwise_overlaps_kernel(bboxes0, bboxes1):
+    """Loop version of compute_pairwise_overlaps, compiled with numba."""
+    overlaps = np.empty((bboxes0.shape[0], bboxes1.shape[0]))
+    for i in range(bboxes0.shape[0]):
+        area0 = (max(0.0, bboxes0[i, 3] - bboxes0[i, 2] + 1)
+                 * max(0.0, bboxes0[i, 1] - bboxes0[i, 0] + 1))
+        for j in range(bboxes1.shape[0]):
+            area1 = (max(0.0, bboxes1[j, 3] - bboxes1[j, 2] + 1)
+                     * max(0.0, bboxes1[j, 1] - bboxes1[j, 0] + 1))
+            intersection_area = (
+                max(0.0, min(bboxes0[i, 3], bboxes1[j, 3])
+                    - max(bboxes0[i, 2], bboxes1[j, 2]) + 1)
+                * max(0.0, min(bboxes0[i, 1], bboxes1[j, 1])
+                      - max(bboxes0[i, 0], bboxes1[j, 0]) + 1)
+            )
+            overlaps[i, j] = (
+                intersection_area / (area0 + area1 - intersection_area))
+    return overlaps
+
+
+if njit is not None:
+    _pairwise_overlaps_kernel = njit(cache=True)(_pairwise_overlaps_kernel)
+
+
+def mean_pool_vectors(word_lists, w2v):
+    """
+    Average the vectors of each list of words in a single pass.
+
+    Every word must be in 'w2v' (KeyError otherwise), empty lists
+    are mapped to zero vectors.
+    Returns a (len(word_lists), dim) float32 array.
+    """
+    w2row = {word: w for w, word in enumerate(w2v)}
+    vectors = np.stack(list(w2v.values())).astype(np.float32, copy=False)
+    rows = [[w2row[word] for word in words] for words in word_lists]
+    lengths = np.array([len(row) for row in rows], dtype=np.int64)
+    means = np.zeros((len(rows), vectors.shape[1]), dtype=np.float32)
+    nonempty = lengths > 0
+    if nonempty.any():
+        word_rows = np.array(
+            [w for row in rows for w in row], dtype=np.int64)
+        offsets = (np.cumsum(lengths) - lengths)[nonempty]
+        sums = np.add.reduceat(vectors[word_rows], offsets, axis=0)
+        means[nonempty] = sums / lengths[nonempty, None].astype(np.float32)
+    return means
+
+
+def _load_json(path):
+    """Load json file 'path', with orjson if available."""
+    if orjson is None:
+        with open(path) as fid:
+            return json.load(fid)
+    with open(path, 'rb') as fid:
+        return orjson.loads(fid.read())
+
+
+def _dump_json(obj, path):
+    """Dump 'obj' into json file 'path', with orjson if available."""
+    if orjson is None:
+        with open(path, 'w') as fid:
+            json.dump(obj, fid)
+        return
+    with open(path, 'wb') as fid:
+        fid.write(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY))
+
+
+def _map_chunks(func, annos, *args):
+    """Apply 'func(chunk, *args)' to chunks of 'annos' in parallel."""
+    n_chunks = min(cpu_count(), _MAX_CHUNKS, len(annos))
+    if n_chunks <= 1:  # not worth pickling annotations to a worker
+        return [func(annos, *args)]
+    chunk_size = -(-len(annos) // n_chunks)
+    return Parallel(n_jobs=n_chunks)(
+        delayed(func)(annos[start:start + chunk_size], *args)
+        for start in range(0, len(annos), chunk_size)
+    )
+
+
+def _flatten(chunks):
+    """Concatenate a list of lists."""
+    return [item for chunk in chunks for item in chunk]
+
+
+def _create_pred_cls_chunk(annos, n_predicates):
+    """Annotate all possible pairs of a chunk of annotations."""
+    predcls_annos = []
+    for anno in annos:
+        pairs = defaultdict(list)
+        for rel in range(len(anno['relations']['subj_ids'])):
+            subj_id = anno['relations']['subj_ids'][rel]
+            obj_id = anno['relations']['obj_ids'][rel]
+            pairs[(subj_id, obj_id)].append((
+                anno['relations']['names'][rel],
+                anno['relations']['ids'][rel]
+            ))
+        # All ordered pairs of different objects, then annotated self-pairs
+        n_objects = len(anno['objects']['ids'])
+        candidates = chain(
+            (
+                (s, o) for s in range(n_objects) for o in range(n_objects)
+                if s != o
+            ),
+            (pair for pair in pairs if pair[0] == pair[1])
+        )
+        background = [('__background__', n_predicates - 1)]
+        subj_ids, obj_ids, names, ids = [], [], [], []
+        for subj_id, obj_id in candidates:
+            rels = pairs.get((subj_id, obj_id))
+            for name, pred_id in (rels if rels else background):
+                subj_ids.append(subj_id)
+                obj_ids.append(obj_id)
+                names.append(name)
+                ids.append(pred_id)
+        relations = dict(anno['relations'])
+        if subj_ids:
+            relations = {
+                'subj_ids': subj_ids,
+                'obj_ids': obj_ids,
+                'names': names,
+                'ids': ids
+            }
+        predcls_annos.append(dict(anno, relations=relations))
+    return predcls_annos
+
+
+def _unique_triplets_chunk(annos, shape):
+    """Return flat (subj, obj, pred) indices of training images."""
+    triplets = []
+    for anno in annos:
+        if anno['split_id'] == 0 and anno['relations']['names']:
+            ids = np.array(anno['objects']['ids'])
+            # Each class triplet is counted at most once per image
+            triplets.append(np.unique(np.ravel_multi_index((
+                ids[anno['relations']['subj_ids']],
+                ids[anno['relations']['obj_ids']],
+                anno['relations']['ids']
+            ), shape)))
+    return np.concatenate(triplets) if triplets else np.zeros(0, int)
+
+
+def _mine_negatives_chunk(annos, r1_preds, r2_preds):
+    """Mine negative examples of a chunk of annotations."""
+    negatives = {}
+    for anno in annos:
+        relations = anno['relations']
+        if not relations['names']:
+            negatives[anno['filename']] = []
+            continue
+        boxes = np.asarray(anno['objects']['boxes'])
+        subj_ids = np.asarray(relations['subj_ids'])
+        obj_ids = np.asarray(relations['obj_ids'])
+        names = np.asarray(relations['names'])
+        # Masks are indexed as [n, r]: relation n forbids relation r
+        other_name = names[:, None] != names[None, :]  # not with P
+        same_subj = subj_ids[:, None] == subj_ids[None, :]
+        same_obj = obj_ids[:, None] == obj_ids[None, :]
+        r1_mask = (
+            ~same_subj  # not S1
+            & (compute_pairwise_overlaps(
+                boxes[subj_ids], boxes[subj_ids]) < 0.9)
+            & other_name
+            & same_obj  # same O
+        )
+        r2_mask = (
+            same_subj  # same S
+            & other_name
+            & ~same_obj  # not O1
+            & (compute_pairwise_overlaps(
+                boxes[obj_ids], boxes[obj_ids]) < 0.9)
+        )
+        is_r1 = np.isin(names, list(r1_preds))
+        is_r2 = ~is_r1 & np.isin(names, list(r2_preds))
+        rule_applies = (
+            (is_r1[:, None] & r1_mask) | (is_r2[:, None] & r2_mask)
+        )
+        neg_ids = [[] for _ in range(len(relations['ids']))]
+        for r_cnt, n_cnt in zip(*rule_applies.T.nonzero()):
+            neg_ids[r_cnt].append(relations['ids'][n_cnt])
+        negatives[anno['filename']] = neg_ids
+    return negatives
+
+
+def _transform_annotations_chunk(annos):
+    """Transform relationship annotations of a chunk of annotations."""
+    transformed_annos = []
+    for anno in annos:
+        # Insertion-ordered dedup, so objects with equal sort keys keep
+        # their first-appearance order (older outputs used set order)
+        seen = {}
+        for rel in anno['relationships']:
+            seen.setdefault(
+                (tuple(rel['subject_box']), rel['subject']), None)
+            seen.setdefault(
+                (tuple(rel['object_box']), rel['object']), None)
+        objects = sorted(seen, key=lambda t: (t[0][2] + t[0][3]))
+        obj_dict = {obj_tuple: o for o, obj_tuple in enumerate(objects)}
+        transformed_annos.append({
+            'filename': anno['filename'],
+            'split_id': anno['split_id'],
+            'height': anno['height'],
+            'width': anno['width'],
+            'objects': {
+                'names': [obj[1] for obj in objects],
+                'boxes': [obj[0] for obj in objects]
+            },
+            'relations': {
+                'names': [
+                    rel['predicate'] for rel in anno['relationships']],
+                'subj_ids': [
+                    obj_dict[(tuple(rel['subject_box']), rel['subject'])]
+                    for rel in anno['relationships']],
+                'obj_ids': [
+                    obj_dict[(tuple(rel['object_box']), rel['object'])]
+                    for rel in anno['relationships']]
+            }
+        })
+    return transformed_annos
+
+
+def _dump_json_list(annos, path):
+    """Stream list 'annos' into json file 'path', one item at a time."""
+    with open(path, 'wb') as fid:
+        fid.write(b'[')
+        for a, anno in enumerate(annos):
+            if a:
+                fid.write(b',')
+            if orjson is None:
+                fid.write(json.dumps(anno).encode())
+            else:
+                fid.write(orjson.dumps(
+                    anno, option=orjson.OPT_SERIALIZE_NUMPY))
+        fid.write(b']')
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 """Class to compute precision metrics for relationship detection."""
 
-import pickle
 import json
 
 import numpy as np
 
+from common.tools import load_merged_connections
+
 
 R1_PREDS = {'VRD': {'carry', 'contain', 'cover', 'drive', 'eat', 'feed', 'fly', 'has', 'hit',
                     'hold', 'kick', 'play with', 'pull', 'ride', 'touch', 'use', 'wear', 'with'},
@@ -63,8 +64,7 @@ class NegativesEvaluator:
         if use_merged:
             dataset = annotation_loader._dataset
             json_path = annotation_loader._json_path
-            with open(json_path + dataset + '_merged.pkl', 'rb') as fid:
-                self._connections = pickle.load(fid)
+            self._connections = load_merged_connections(json_path, dataset)
 
     def reset(self):
         """Initialize counters."""
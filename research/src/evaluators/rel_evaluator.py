@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 """Class to compute recall metrics for VRD-SGGen."""
 
-import pickle
-
 import numpy as np
 
+from common.tools import load_merged_connections
+
 
 class RelationshipEvaluator:
     """A class providing methods to evaluate the VRD-SGGen problem."""
@@ -36,8 +36,7 @@ class RelationshipEvaluator:
         if use_merged:
             dataset = annotation_loader._dataset
             json_path = annotation_loader._json_path
-            with open(json_path + dataset + '_merged.pkl', 'rb') as fid:
-                self._connections = pickle.load(fid)
+            self._connections = load_merged_connections(json_path, dataset)
 
     def reset(self):
         """Initialize recall_counters."""
@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 """Class to compute accuracy metrics for predicate classification."""
 
-import pickle
-
 import numpy as np
 
+from common.tools import load_merged_connections
+
 
 class RelationshipClsEvaluator:
     """A class providing methods to evaluate predicate accuracy."""
@@ -26,8 +26,7 @@ class RelationshipClsEvaluator:
         if use_merged:
             dataset = annotation_loader._dataset
             json_path = annotation_loader._json_path
-            with open(json_path + dataset + '_merged.pkl', 'rb') as fid:
-                self._connections = pickle.load(fid)
+            self._connections = load_merged_connections(json_path, dataset)
 
     def reset(self):
         """Initialize counters."""